@@ -0,0 +1,185 @@
+"""
+Images, fonts and other data the game needs at startup, cached on disk
+so a new process does not have to do the same work again.
+
+The images are scaled once and stored as raw RGBA pixels in one atlas
+file that is memory mapped, so no PNG is decoded or scaled on startup.
+Font names are resolved to a font file once, because looking up a
+system font scans all fonts of the system. Anything else that is slow
+to build and only depends on the images can be cached with
+cached_array.
+
+The cache lives in .cache next to this file, or in FLAPPY_CACHE. It is
+rebuilt when an image in imgs/ changes and can be deleted at any time.
+"""
+import hashlib
+import json
+import os
+import pygame
+import numpy as np
+
+LOCAL_DIR = os.path.dirname(os.path.abspath(__file__))
+IMG_DIR = os.path.join(LOCAL_DIR, "imgs")
+CACHE_DIR = os.environ.get("FLAPPY_CACHE", os.path.join(LOCAL_DIR, ".cache"))
+
+# name: (file in imgs/, scale), scale is a factor for scale2x or a size for scale
+IMAGES = {
+    "pipe": ("pipe.png", 2),
+    "bg": ("bg.png", (600, 900)),
+    "bird1": ("bird1.png", 2),
+    "bird2": ("bird2.png", 2),
+    "bird3": ("bird3.png", 2),
+    "base": ("base.png", 2),
+}
+
+
+def images_key():
+    """
+    short hash of the image files and how they are scaled, changes when an image changes
+    :return: str
+    """
+    digest = hashlib.sha1(repr(sorted(IMAGES.items())).encode())
+    for file_name, scale in sorted(IMAGES.values()):
+        stat = os.stat(os.path.join(IMG_DIR, file_name))
+        digest.update(("%s %d %d" % (file_name, stat.st_size, stat.st_mtime_ns)).encode())
+    return digest.hexdigest()[:16]
+
+
+def save_array(path, array):
+    """
+    write an array to a .npy file, in one go so other processes never see half a file
+    :param path: file name
+    :param array: numpy array
+    :return: None
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp, path)
+
+
+def save_json(path, data):
+    """
+    write data to a JSON file, in one go like save_array
+    :param path: file name
+    :param data: anything json can write
+    :return: None
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def cached_array(name, build, key=None):
+    """
+    an array from the cache, built and stored the first time. The
+    cache entry is tied to the images and to key, so build may only
+    depend on those
+    :param name: name of the array in the cache (str)
+    :param build: function that makes the array
+    :param key: anything else the array depends on, its repr is hashed
+                into the file name
+    :return: read only memory mapped array, or the array build made
+             when the cache can not be written
+    """
+    name = "%s-%s" % (name, images_key())
+    if key is not None:
+        name += "-" + hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    path = os.path.join(CACHE_DIR, name + ".npy")
+    if not os.path.exists(path):
+        array = build()
+        try:
+            save_array(path, array)
+        except OSError:
+            return array  # e.g. a read only checkout, do without the cache
+    return np.load(path, mmap_mode="r")
+
+
+def scale_image(file_name, scale):
+    """
+    load an image from imgs/ and scale it
+    :param file_name: str
+    :param scale: 2 for scale2x, or a (width, height) size
+    :return: pygame Surface
+    """
+    img = pygame.image.load(os.path.join(IMG_DIR, file_name))
+    if scale == 2:
+        return pygame.transform.scale2x(img)
+    return pygame.transform.scale(img, scale)
+
+
+def build_atlas():
+    """
+    scale all images and put their RGBA pixels one after the other in one array
+    :return: (uint8 array, {name: (offset, width, height)})
+    """
+    chunks = []
+    index = {}
+    offset = 0
+    for name, (file_name, scale) in IMAGES.items():
+        img = scale_image(file_name, scale)
+        pixels = pygame.image.tobytes(img, "RGBA")
+        index[name] = (offset, img.get_width(), img.get_height())
+        chunks.append(np.frombuffer(pixels, dtype=np.uint8))
+        offset += len(pixels)
+    return np.concatenate(chunks), index
+
+
+def load_images():
+    """
+    all images of IMAGES, scaled. They come from the memory mapped atlas
+    and share its memory, convert them once there is a display
+    :return: {name: pygame Surface}
+    """
+    key = images_key()
+    path = os.path.join(CACHE_DIR, "atlas-%s.npy" % key)
+    index_path = os.path.join(CACHE_DIR, "atlas-%s.json" % key)
+    if os.path.exists(path) and os.path.exists(index_path):
+        # copy on write, the surfaces need a writable buffer but never write to it
+        atlas = np.load(path, mmap_mode="c")
+        with open(index_path) as f:
+            index = json.load(f)
+    else:
+        atlas, index = build_atlas()
+        try:
+            save_array(path, atlas)
+            save_json(index_path, index)
+        except OSError:
+            pass  # e.g. a read only checkout, use the atlas just built
+    return {name: pygame.image.frombuffer(atlas[offset:offset + width * height * 4], (width, height), "RGBA")
+            for name, (offset, width, height) in index.items()}
+
+
+def font_path(name):
+    """
+    the file of a system font, looked up once and then remembered in the cache
+    :param name: font name (str)
+    :return: file name, or None when the system has no such font
+    """
+    path = os.path.join(CACHE_DIR, "fonts.json")
+    fonts = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            fonts = json.load(f)
+    if name not in fonts or (fonts[name] is not None and not os.path.exists(fonts[name])):
+        fonts[name] = pygame.font.match_font(name)
+        try:
+            save_json(path, fonts)
+        except OSError:
+            pass  # e.g. a read only checkout, look it up again next time
+    return fonts[name]
+
+
+def load_font(name, size):
+    """
+    same font as pygame.font.SysFont(name, size) without scanning the system fonts
+    :param name: font name (str)
+    :param size: int
+    :return: pygame Font, the default font when the system has no such font
+    """
+    if not pygame.font.get_init():
+        pygame.font.init()
+    return pygame.font.Font(font_path(name), size)
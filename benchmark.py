@@ -0,0 +1,322 @@
+"""
+Benchmarks for the flappy bird NEAT training code. Measures the
+training loop, collision, network activation, drawing and startup
+for a few population sizes, headless and rendered, and writes the
+results to JSON. Compared against a stored baseline it flags every
+number that got worse by more than the tolerance.
+
+Usage:
+    python benchmark.py --pop 100 1000 --output bench.json
+    python benchmark.py --baseline bench.json
+
+Every mode runs in its own process, so the rendered mode's window
+and converted images do not affect the headless numbers. Set SDL_VIDEODRIVER=dummy to run
+the rendered mode on a machine without a display.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+LOCAL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# for every metric: True when higher is better
+METRICS = {
+    "loop_fps": True,
+    "collide_per_sec": True,
+    "flock_collide_birds_per_sec": True,
+    "activate_per_sec": True,
+    "batch_activate_birds_per_sec": True,
+    "draw_ms_per_frame": False,
+    "startup_sec": False,
+}
+
+
+def make_nets(fb, config, pop_size, seed=0):
+    """
+    random networks like the ones of a first generation, with some mutations
+    :param fb: the flappy_bird_neat module
+    :param config: neat config
+    :param pop_size: number of networks (int)
+    :param seed: int
+    :return: list of neat.nn.FeedForwardNetwork
+    """
+    import neat
+    random.seed(seed)
+    nets = []
+    for key in range(pop_size):
+        genome = config.genome_type(key)
+        genome.configure_new(config.genome_config)
+        for _ in range(random.randrange(10)):
+            genome.mutate(config.genome_config)
+        nets.append(neat.nn.FeedForwardNetwork.create(genome, config))
+    return nets
+
+
+def bench_loop(fb, nets, draw, min_frames):
+    """
+    frames per second of the training loop (simulate)
+    :param fb: the flappy_bird_neat module
+    :param nets: list of networks, one bird each
+    :param draw: draw every frame
+    :param min_frames: keep playing games until this many frames are simulated
+    :return: float
+    """
+    class CountingBudget(fb.Budget):
+        frames = 0
+
+        def check(self, frames, deadline, score):
+            self.frames = frames
+            return fb.Budget.check(self, frames, deadline, score)
+
+    frames = 0
+    seconds = 0.0
+    seed = 0
+    while frames < min_frames:
+        budget = CountingBudget(max_frames=min_frames - frames)
+        start = time.perf_counter()
+        fb.simulate(fb.NetworkBatch(nets), fb.Course(seed), draw=draw, budget=budget)
+        seconds += time.perf_counter() - start
+        frames += budget.frames
+        seed += 1
+    return frames / seconds
+
+
+def bench_collide(fb, seconds=0.5):
+    """
+    Pipe.collide calls per second, for a bird flying through a pipe.
+    Training collides through Flock.collide, see bench_flock_collide
+    :param fb: the flappy_bird_neat module
+    :param seconds: how long to measure (float)
+    :return: float
+    """
+    bird = fb.Bird(230, 350)
+    pipe = fb.Pipe(230, fb.Course(0), 0)
+    offsets = range(-120, 120, 4)
+    calls = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for dx in offsets:
+            pipe.x = 230 + dx
+            pipe.collide(bird, None)
+        calls += len(offsets)
+    return calls / (time.perf_counter() - start)
+
+
+def bench_flock_collide(fb, pop_size, seconds=0.5):
+    """
+    birds per second checked by Flock.collide, the collision of the
+    training loop, for a flock spread over the height of a pipe gap
+    :param fb: the flappy_bird_neat module
+    :param pop_size: number of birds (int)
+    :param seconds: how long to measure (float)
+    :return: float
+    """
+    import numpy as np
+    flock = fb.Flock(230, 350, pop_size)
+    flock.y[:] = np.linspace(100, 600, pop_size)
+    flock.img[:] = np.arange(pop_size) % len(fb.Flock.IMGS)
+    flock.tilt[:] = np.linspace(-90, 25, pop_size).astype(int)
+    ids = flock.alive
+    pipe = fb.Pipe(230, fb.Course(0), 0)
+    offsets = range(-120, 120, 4)
+    birds = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for dx in offsets:
+            pipe.x = 230 + dx
+            flock.collide(pipe, ids)
+        birds += len(offsets) * pop_size
+    return birds / (time.perf_counter() - start)
+
+
+def bench_activate(fb, nets, seconds=0.5):
+    """
+    FeedForwardNetwork.activate calls per second, and birds per second
+    activated by NetworkBatch.activate
+    :param fb: the flappy_bird_neat module
+    :param nets: list of networks
+    :param seconds: how long to measure each (float)
+    :return: (float, float)
+    """
+    import numpy as np
+    inputs = (350.0, 120.0, 40.0)
+    calls = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for net in nets:
+            net.activate(inputs)
+        calls += len(nets)
+    single = calls / (time.perf_counter() - start)
+
+    batch = fb.NetworkBatch(nets)
+    ids = np.arange(len(nets))
+    matrix = np.tile(inputs, (len(nets), 1))
+    birds = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        batch.activate(ids, matrix)
+        birds += len(nets)
+    return single, birds / (time.perf_counter() - start)
+
+
+def bench_draw(fb, pop_size, frames=60):
+    """
+    milliseconds draw_window takes for one frame with pop_size birds
+    :param fb: the flappy_bird_neat module
+    :param pop_size: number of birds (int)
+    :param frames: frames to average over (int)
+    :return: float
+    """
+    import numpy as np
+    flock = fb.Flock(230, 350, pop_size)
+    flock.y[:] = np.linspace(100, 600, pop_size)
+    course = fb.Course(0)
+    pipes = [fb.Pipe(300, course, 0), fb.Pipe(650, course, 1)]
+    base = fb.Base(fb.FLOOR)
+    win = fb.init_display()
+    start = time.perf_counter()
+    for frame in range(frames):
+        flock.animate(flock.alive)
+        base.move()
+        fb.draw_window(win, flock, pipes, base, frame, 1, 0)
+    return (time.perf_counter() - start) / frames * 1000
+
+
+def bench_startup(headless):
+    """
+    seconds from starting python until the first frame is simulated
+    :param headless: bool
+    :return: float
+    """
+    env = dict(os.environ, FLAPPY_HEADLESS="1" if headless else "0")
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import benchmark; benchmark.probe()"], cwd=LOCAL_DIR, env=env,
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def probe():
+    """
+    import the game and simulate one frame with one bird, for bench_startup
+    :return: None
+    """
+    import neat
+    import flappy_bird_neat as fb
+    if not fb.HEADLESS:
+        fb.init_display()
+    net = neat.nn.FeedForwardNetwork([-1, -2, -3], [0], [])
+    fb.simulate(fb.NetworkBatch([net]), fb.Course(0), budget=fb.Budget(max_frames=1))
+
+
+def run_mode(headless, pop_sizes, min_frames):
+    """
+    run all benchmarks of one mode, in this process
+    :param headless: bool
+    :param pop_sizes: list of ints
+    :param min_frames: frames to simulate per population size (int)
+    :return: dict
+    """
+    import neat
+    import flappy_bird_neat as fb
+    fb.FPS = 0  # measure the loop, not the frame cap
+
+    config = neat.config.Config(neat.DefaultGenome, neat.DefaultReproduction,
+                                neat.DefaultSpeciesSet, neat.DefaultStagnation,
+                                os.path.join(LOCAL_DIR, "config-feedforward.txt"))
+    results = {"collide_per_sec": bench_collide(fb)}
+    for pop_size in pop_sizes:
+        nets = make_nets(fb, config, pop_size)
+        single, batch = bench_activate(fb, nets)
+        result = {
+            "loop_fps": bench_loop(fb, nets, not headless, min_frames),
+            "activate_per_sec": single,
+            "batch_activate_birds_per_sec": batch,
+            "flock_collide_birds_per_sec": bench_flock_collide(fb, pop_size),
+        }
+        if not headless:
+            result["draw_ms_per_frame"] = bench_draw(fb, pop_size)
+        results["pop=%d" % pop_size] = result
+    return results
+
+
+def flatten(results, prefix=""):
+    """
+    flatten nested results to {"mode/pop=100/metric": value}
+    :param results: dict
+    :param prefix: str
+    :return: dict
+    """
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "/"))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    """
+    find the numbers that got worse than the baseline by more than tolerance
+    :param results: dict of results
+    :param baseline: dict of baseline results
+    :param tolerance: allowed relative change (float)
+    :return: list of messages, one per regression
+    """
+    regressions = []
+    old = flatten(baseline["results"])
+    for key, value in flatten(results["results"]).items():
+        metric = key.rsplit("/", 1)[-1]
+        if key not in old or metric not in METRICS or not old[key]:
+            continue
+        change = (value - old[key]) / old[key]
+        worse = -change if METRICS[metric] else change
+        if worse > tolerance:
+            regressions.append("%s: %.4g -> %.4g (%+.1f%%)" % (key, old[key], value, 100 * change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the flappy bird NEAT training code")
+    parser.add_argument("--pop", type=int, nargs="+", default=[100, 1000], help="population sizes")
+    parser.add_argument("--modes", nargs="+", default=["headless", "rendered"], choices=["headless", "rendered"])
+    parser.add_argument("--frames", type=int, default=2000, help="frames to simulate per population size")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of earlier results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown against the baseline (0.1 = 10%%)")
+    parser.add_argument("--mode", help=argparse.SUPPRESS)  # used for the per-mode subprocesses
+    args = parser.parse_args(argv)
+
+    if args.mode:
+        json.dump(run_mode(args.mode == "headless", args.pop, args.frames), sys.stdout)
+        return
+
+    results = {"python": sys.version.split()[0], "pop": args.pop, "results": {}}
+    for mode in args.modes:
+        env = dict(os.environ, FLAPPY_HEADLESS="1" if mode == "headless" else "0", PYGAME_HIDE_SUPPORT_PROMPT="1")
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "--mode", mode, "--frames", str(args.frames),
+                              "--pop"] + [str(pop) for pop in args.pop],
+                             cwd=LOCAL_DIR, env=env, check=True, stdout=subprocess.PIPE).stdout
+        results["results"][mode] = json.loads(out.decode().splitlines()[-1])
+        results["results"][mode]["startup_sec"] = bench_startup(mode == "headless")
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
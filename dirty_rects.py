@@ -0,0 +1,113 @@
+"""
+Dirty rectangle rendering for the flappy bird windows. Instead of
+blitting the whole background and updating the whole window every
+frame, only the places where something was drawn last frame are
+cleared, and only those and the places drawn this frame are sent to
+the display. When that adds up to most of the window a normal full
+update is done instead.
+
+Usage:
+    screen = DirtyRenderer(WIN, bg_img)
+    screen.begin()
+    pipe.draw(screen)  # anything that draws with blit or blits
+    screen.update()
+"""
+import pygame
+import numpy as np
+
+CELL = 8  # size in pixels of the cells the dirty area is measured in
+
+
+class DirtyRenderer:
+    """
+    Stands in for the window surface in draw functions: blit and
+    blits draw to the window and remember where they drew
+    """
+
+    def __init__(self, win, background, max_fraction=0.5):
+        """
+        :param win: pygame window surface
+        :param background: surface drawn behind everything, at (0, 0)
+        :param max_fraction: update the whole window when the dirty
+                             rects cover more than this part of it
+        :return: None
+        """
+        self.win = win
+        self.background = background
+        self.max_fraction = max_fraction
+        # cells of the window touched by a dirty rect, rects overlap a lot
+        # (a pipe before and after moving) so their areas can not just be added
+        self.cells = np.zeros((win.get_height() // CELL + 1, win.get_width() // CELL + 1), dtype=bool)
+        self.old = []  # rects drawn last frame
+        self.new = []  # rects drawn this frame
+        self.full = True  # next frame redraws the whole window
+
+    def invalidate(self):
+        """
+        redraw and update the whole window next frame, e.g. after
+        something was drawn to the window without the renderer
+        :return: None
+        """
+        self.full = True
+
+    def begin(self):
+        """
+        start a frame by clearing what was drawn last frame
+        :return: None
+        """
+        if self.full:
+            self.win.blit(self.background, (0,0))
+        else:
+            for rect in self.old:
+                self.win.blit(self.background, rect, rect)
+
+    def blit(self, source, dest, area=None, special_flags=0):
+        """
+        same as Surface.blit on the window
+        :return: the rect that was drawn
+        """
+        rect = self.win.blit(source, dest, area, special_flags)
+        self.new.append(rect)
+        return rect
+
+    def blits(self, blit_sequence, doreturn=1):
+        """
+        same as Surface.blits on the window
+        :return: the rects that were drawn
+        """
+        rects = self.win.blits(blit_sequence)
+        self.new.extend(rects)
+        return rects
+
+    def mark(self, rect):
+        """
+        add a rect that was drawn to the window some other way, e.g. with pygame.draw
+        :param rect: pygame Rect
+        :return: None
+        """
+        self.new.append(rect)
+
+    def dirty_fraction(self, rects):
+        """
+        how much of the window the rects cover together
+        :param rects: list of pygame Rects inside the window
+        :return: float from 0 to 1
+        """
+        self.cells[:] = False
+        for rect in rects:
+            self.cells[rect.top // CELL:(rect.bottom + CELL - 1) // CELL, rect.left // CELL:(rect.right + CELL - 1) // CELL] = True
+        return self.cells.mean()
+
+    def update(self):
+        """
+        end a frame by updating the parts of the window that changed
+        :return: None
+        """
+        rects = self.old + self.new
+        if self.full or self.dirty_fraction(rects) > self.max_fraction:
+            pygame.display.update()
+        else:
+            pygame.display.update(rects)
+        self.old = self.new
+        self.new = []
+        self.full = False
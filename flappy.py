@@ -0,0 +1,137 @@
+"""
+Command line entry point of the flappy bird game and its NEAT training.
+
+Usage:
+    python flappy.py play
+    python flappy.py train --headless --workers 4 --save best.pickle
+    python flappy.py replay best.pickle
+    python flappy.py bench --pop 100 1000
+
+None of the modules opens a window when it is imported, only the
+commands that draw do.
+"""
+import argparse
+import os
+import random
+import sys
+
+LOCAL_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_PATH = os.path.join(LOCAL_DIR, "config-feedforward.txt")
+
+
+def train(args):
+    """
+    train a population with the options of the train command
+    :param args: parsed arguments
+    :return: None
+    """
+    import flappy_bird_neat as fb
+    if args.headless:
+        fb.HEADLESS = True
+    if args.timing:
+        fb.TIMER = fb.PhaseTimer()
+    fb.SEED = args.seed
+    if args.fixed_course:
+        fb.FIXED_COURSE = True
+        if fb.SEED is None:
+            fb.SEED = random.randrange(2**32)
+    if args.fitness_cache:
+        fb.FITNESS_CACHE = fb.FitnessCache()
+    fb.RENDER_EVERY = max(1, args.render_every)
+    fb.RENDER_FPS = args.render_fps
+    fb.LOD_BIRDS = args.lod
+    fb.LOD_POINTS = not args.lod_hide
+    fb.DIRTY_RECTS = args.dirty_rects
+    fb.ROTATED_COLLISION = args.rotated_collision
+    fb.BUDGET = fb.Budget(args.max_frames, args.max_seconds, args.max_score)
+    fb.run(args.config, args.workers, args.generations, args.save)
+
+
+def play(args):
+    """
+    play the game yourself
+    :param args: parsed arguments
+    :return: None
+    """
+    import flappy_bird
+    flappy_bird.DIRTY_RECTS = args.dirty_rects
+    flappy_bird.main(flappy_bird.init_display())
+
+
+def replay(args):
+    """
+    watch a saved genome play
+    :param args: parsed arguments
+    :return: None
+    """
+    import flappy_bird_neat as fb
+    fb.BUDGET = fb.Budget(max_score=args.max_score)
+    print("Fitness: %.1f" % fb.replay(args.genome, args.config, args.seed))
+
+
+def bench(args):
+    """
+    run the benchmarks, with the options of benchmark.py
+    :param args: parsed arguments
+    :return: None
+    """
+    import benchmark
+    benchmark.main(args.args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Flappy bird and a NEAT network that learns to play it")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("train", help="train a NEAT network to play flappy bird")
+    command.add_argument("--config", default=CONFIG_PATH, help="NEAT config file")
+    command.add_argument("--generations", type=int, default=50, help="number of generations to run for")
+    command.add_argument("--save", help="pickle the best genome to this file")
+    command.add_argument("--headless", action="store_true", help="train without a window (or set FLAPPY_HEADLESS=1)")
+    command.add_argument("--workers", type=int, default=1, help="number of processes evaluating genomes")
+    command.add_argument("--seed", type=int, default=None, help="seed of the pipe courses")
+    command.add_argument("--fixed-course", action="store_true", help="fly the same course every generation")
+    command.add_argument("--fitness-cache", action="store_true", help="do not simulate genomes again that flew the same course before, needs --fixed-course. Not used when the training is drawn")
+    command.add_argument("--max-frames", type=int, default=None, help="end a generation after this many frames")
+    command.add_argument("--max-seconds", type=float, default=None, help="end a generation after this many seconds")
+    command.add_argument("--max-score", type=int, default=None, help="end a generation once this many pipes are passed")
+    command.add_argument("--render-every", type=int, default=1, help="draw 1 of every N frames, change it with the up/down arrows")
+    command.add_argument("--render-fps", type=float, default=0, help="draw at most this many frames per second instead")
+    command.add_argument("--lod", type=int, default=0, help="draw only the N fittest birds as sprites and the rest as dots")
+    command.add_argument("--lod-hide", action="store_true", help="with --lod, do not draw the other birds at all")
+    command.add_argument("--dirty-rects", action="store_true", help="only update the parts of the window that changed")
+    command.add_argument("--rotated-collision", action="store_true", help="collide the birds with their rotated sprites instead of the upright images")
+    command.add_argument("--timing", action="store_true", help="report how long each phase of a frame takes")
+    command.set_defaults(func=train)
+
+    command = commands.add_parser("play", help="play the game yourself")
+    command.add_argument("--dirty-rects", action="store_true", help="only update the parts of the window that changed")
+    command.set_defaults(func=play)
+
+    command = commands.add_parser("replay", help="watch a genome saved by train --save play")
+    command.add_argument("genome", help="pickled genome")
+    command.add_argument("--config", default=CONFIG_PATH, help="NEAT config file")
+    command.add_argument("--seed", type=int, default=None, help="seed of the pipe course")
+    command.add_argument("--max-score", type=int, default=None, help="end the game once this many pipes are passed")
+    command.set_defaults(func=replay)
+
+    # the options of bench are passed on to benchmark.py as they are
+    command = commands.add_parser("bench", help="benchmark the training code, see bench --help", add_help=False)
+    command.set_defaults(func=bench)
+
+    args, args.args = parser.parse_known_args(argv)
+    if args.args and args.command != "bench":
+        parser.error("unrecognized arguments: " + " ".join(args.args))
+    if args.command == "train" and args.fitness_cache and not args.fixed_course:
+        # the cache only hits when every generation flies the same course
+        parser.error("--fitness-cache needs --fixed-course")
+    try:
+        args.func(args)
+    except KeyboardInterrupt:
+        # the workers of train have been stopped by now
+        print("\nInterrupted")
+        sys.exit(130)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,24 +7,30 @@ Author: Tech With Tim
 """
 import pygame
 import random
-import os
 import time
-pygame.font.init()  # init font
+from dirty_rects import DirtyRenderer
+import assets
 
 WIN_WIDTH = 600
 WIN_HEIGHT = 800
 PIPE_VEL = 5
 FLOOR = 730
-STAT_FONT = pygame.font.SysFont("comicsans", 50)
-END_FONT = pygame.font.SysFont("comicsans", 70)
-
-WIN = pygame.display.set_mode((WIN_WIDTH, WIN_HEIGHT))
-pygame.display.set_caption("Flappy Bird")
-
-pipe_img = pygame.transform.scale2x(pygame.image.load(os.path.join("imgs","pipe.png")).convert_alpha())
-bg_img = pygame.transform.scale(pygame.image.load(os.path.join("imgs","bg.png")).convert_alpha(), (600, 900))
-bird_images = [pygame.transform.scale2x(pygame.image.load(os.path.join("imgs","bird" + str(x) + ".png"))) for x in range(1,4)]
-base_img = pygame.transform.scale2x(pygame.image.load(os.path.join("imgs","base.png")).convert_alpha())
+STEPS_PER_SECOND = 30  # game steps per second, the speed of the game whatever the frame rate
+MAX_STEPS = 5  # most steps taken in one frame to catch up after a slow frame
+FPS = 60  # frame rate cap
+DIRTY_RECTS = False  # only redraw and update the parts of the window that changed
+MENU, PLAYING, GAME_OVER = "menu", "playing", "game over"  # states of the game
+# made by init_display, so the module can be imported without a display
+WIN = None
+STAT_FONT = END_FONT = None
+dirty = None
+end_label = None
+
+images = assets.load_images()  # scaled, from the memory mapped atlas
+pipe_img = images["pipe"]
+bg_img = images["bg"]
+bird_images = [images["bird" + str(x)] for x in range(1,4)]
+base_img = images["base"]
 
 class Bird:
     """
@@ -44,9 +50,18 @@ class Bird:
         :param y: starting y pos (int)
         :return: None
         """
+        self.gravity = 9.8
+        self.reset(x, y)
+
+    def reset(self, x, y):
+        """
+        put the bird back at the start, for a new game
+        :param x: starting x pos (int)
+        :param y: starting y pos (int)
+        :return: None
+        """
         self.x = x
         self.y = y
-        self.gravity = 9.8
         self.tilt = 0  # degrees to tilt
         self.tick_count = 0
         self.vel = 0
@@ -89,10 +104,11 @@ class Bird:
             if self.tilt > -90:
                 self.tilt -= self.ROT_VEL
 
-    def draw(self, win):
+    def animate(self):
         """
-        draw the bird
-        :param win: pygame window or surface
+        advance the flapping animation and pick the current image.
+        Called once per game step, so the wings flap and the bird
+        collides the same whatever the frame rate
         :return: None
         """
         self.img_count += 1
@@ -115,7 +131,12 @@ class Bird:
             self.img = self.IMGS[1]
             self.img_count = self.ANIMATION_TIME*2
 
-
+    def draw(self, win):
+        """
+        draw the bird
+        :param win: pygame window or surface
+        :return: None
+        """
         # tilt the bird
         blitRotateCenter(win, self.img, (self.x, self.y), self.tilt)
 
@@ -135,27 +156,32 @@ class Pipe():
     WIN_WIDTH = WIN_WIDTH
     GAP = 160
     VEL = 5
+    # shared by all pipes, a pipe only holds its position
+    PIPE_TOP = pygame.transform.flip(pipe_img, False, True)
+    PIPE_BOTTOM = pipe_img
+    TOP_MASK = pygame.mask.from_surface(PIPE_TOP)
+    BOTTOM_MASK = pygame.mask.from_surface(PIPE_BOTTOM)
+
+    __slots__ = ("x", "height", "top", "bottom", "passed")
 
     def __init__(self, x):
         """
         initialize pipe object
         :param x: int
-        :param y: int
-        :return" None
+        :return: None
         """
-        self.x = x
-        self.height = 0
-        self.gap = 100  # gap between top and bottom pipe
-
-        # where the top and bottom of the pipe is
-        self.top = 0
-        self.bottom = 0
-
-        self.PIPE_TOP = pygame.transform.flip(pipe_img, False, True)
-        self.PIPE_BOTTOM = pipe_img
+        self.reset(x)
 
+    def reset(self, x):
+        """
+        move the pipe to x with a new height, for a pipe that is reused
+        :param x: int
+        :return: None
+        """
+        self.x = x
         self.passed = False
 
+        # sets the height and where the top and bottom of the pipe is
         self.set_height()
 
     def set_height(self):
@@ -193,8 +219,8 @@ class Pipe():
         :return: Bool
         """
         bird_mask = bird.get_mask()
-        top_mask = pygame.mask.from_surface(self.PIPE_TOP)
-        bottom_mask = pygame.mask.from_surface(self.PIPE_BOTTOM)
+        top_mask = self.TOP_MASK
+        bottom_mask = self.BOTTOM_MASK
         top_offset = (self.x - bird.x, self.top - round(bird.y))
         bottom_offset = (self.x - bird.x, self.bottom - round(bird.y))
 
@@ -222,6 +248,13 @@ class Base:
         :return: None
         """
         self.y = y
+        self.reset()
+
+    def reset(self):
+        """
+        move the floor back to where it starts, for a new game
+        :return: None
+        """
         self.x1 = 0
         self.x2 = self.WIDTH
 
@@ -272,25 +305,14 @@ def menu_screen(win):
 
 def end_screen(win):
     """
-    display an end screen when the player loses
+    display an end screen when the player loses, over the last frame
     :param win: the pygame window surface
     :return: None
     """
-    run = True
-    text_label = END_FONT.render("Press Space to Restart", 1, (255,255,255))
-    while run:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                run = False
-
-            if event.type == pygame.KEYDOWN:
-                main(win)
-
-        win.blit(text_label, (WIN_WIDTH/2 - text_label.get_width()/2, 500))
-        pygame.display.update()
-
-    pygame.quit()
-    quit()
+    win.blit(end_label, (WIN_WIDTH/2 - end_label.get_width()/2, 500))
+    pygame.display.update()
+    if dirty is not None:
+        dirty.invalidate()
 
 def draw_window(win, bird, pipes, base, score):
     """
@@ -301,98 +323,169 @@ def draw_window(win, bird, pipes, base, score):
     :param score: score of the game (int)
     :return: None
     """
-    win.blit(bg_img, (0,0))
+    if dirty is not None:
+        screen = dirty
+        screen.begin()
+    else:
+        screen = win
+        win.blit(bg_img, (0,0))
 
     for pipe in pipes:
-        pipe.draw(win)
+        pipe.draw(screen)
 
-    base.draw(win)
-    bird.draw(win)
+    base.draw(screen)
+    bird.draw(screen)
 
     # score
     score_label = STAT_FONT.render("Score: " + str(score),1,(255,255,255))
-    win.blit(score_label, (WIN_WIDTH - score_label.get_width() - 15, 10))
+    screen.blit(score_label, (WIN_WIDTH - score_label.get_width() - 15, 10))
+
+    if screen is win:
+        pygame.display.update()
+    else:
+        screen.update()
 
-    pygame.display.update()
+
+def init_display():
+    """
+    open the window, load the fonts and convert the images for fast
+    blitting, the first time it is called
+    :return: the window surface
+    """
+    global WIN, STAT_FONT, END_FONT, dirty, end_label, pipe_img, bg_img, base_img, bird_images
+    if WIN is not None:
+        return WIN
+
+    STAT_FONT = assets.load_font("comicsans", 50)
+    END_FONT = assets.load_font("comicsans", 70)
+
+    WIN = pygame.display.set_mode((WIN_WIDTH, WIN_HEIGHT))
+    pygame.display.set_caption("Flappy Bird")
+
+    pipe_img = pipe_img.convert_alpha()
+    bg_img = bg_img.convert_alpha()
+    base_img = base_img.convert_alpha()
+    bird_images = [img.convert_alpha() for img in bird_images]
+    Pipe.PIPE_TOP = Pipe.PIPE_TOP.convert_alpha()
+    Pipe.PIPE_BOTTOM = pipe_img
+    Base.IMG = base_img
+    Bird.IMGS = bird_images
+
+    dirty = DirtyRenderer(WIN, bg_img) if DIRTY_RECTS else None
+    end_label = END_FONT.render("Press Space to Restart", 1, (255,255,255))
+    return WIN
+
+
+def new_pipe(x, spare):
+    """
+    a pipe at x, reusing a pipe that went off screen when there is one
+    :param x: int
+    :param spare: list of pipes that are not in use
+    :return: Pipe object
+    """
+    if spare:
+        pipe = spare.pop()
+        pipe.reset(x)
+        return pipe
+    return Pipe(x)
 
 
 def main(win):
     """
-    Runs the main game loop
+    Runs the game: the menu waits for the first jump, the player plays
+    until the bird hits the floor and after game over any key starts
+    a new game. A new game resets the same bird, base and pipes
+    instead of making new ones
     :param win: pygame window surface
     :return: None
     """
     bird = Bird(230,350)
     base = Base(FLOOR)
     pipes = [Pipe(700)]
+    spare = []  # pipes that went off screen, reused for new pipes
     score = 0
 
     clock = pygame.time.Clock()
-    start = False
+    state = MENU
     lost = False
 
-    run = True
-    while run:
-        pygame.time.delay(30)
-        clock.tick(60)
+    step = 1 / STEPS_PER_SECOND
+    lag = 0  # time the game is behind the clock
+
+    while True:
+        lag += clock.tick(FPS) / 1000
 
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
-                run = False
                 pygame.quit()
                 quit()
-                break
 
-            if event.type == pygame.KEYDOWN and not lost:
-                if event.key == pygame.K_SPACE:
-                    if not start:
-                        start = True
+            if event.type == pygame.KEYDOWN:
+                if state == GAME_OVER:
+                    # start a new game with the same objects
+                    bird.reset(230, 350)
+                    base.reset()
+                    spare.extend(pipes)
+                    pipes[:] = [new_pipe(700, spare)]
+                    score = 0
+                    lost = False
+                    state = PLAYING
+                    bird.jump()
+                elif event.key == pygame.K_SPACE and not lost:
+                    state = PLAYING
                     bird.jump()
 
-        # Move Bird, base and pipes
-        if start:
-            bird.move()
-        if not lost:
-            base.move()
-
-            if start:
-                rem = []
-                add_pipe = False
-                for pipe in pipes:
-                    pipe.move()
-                    # check for collision
-                    if pipe.collide(bird, win):
-                        lost = True
+        if state == GAME_OVER:
+            lag = 0
+            end_screen(win)
+            continue
+
+        # advance the game in fixed steps, catching up after a slow frame
+        steps = 0
+        while lag >= step and state != GAME_OVER:
+            lag -= step
+            steps += 1
+            if steps > MAX_STEPS:  # too far behind, let the game slow down instead
+                lag = 0
+                break
 
-                    if pipe.x + pipe.PIPE_TOP.get_width() < 0:
-                        rem.append(pipe)
+            # Move Bird, base and pipes
+            if state == PLAYING:
+                bird.move()
+            bird.animate()
+            if not lost:
+                base.move()
 
-                    if not pipe.passed and pipe.x < bird.x:
-                        pipe.passed = True
-                        add_pipe = True
+                if state == PLAYING:
+                    rem = []
+                    add_pipe = False
+                    for pipe in pipes:
+                        pipe.move()
+                        # check for collision
+                        if pipe.collide(bird, win):
+                            lost = True
 
-                if add_pipe:
-                    score += 1
-                    pipes.append(Pipe(WIN_WIDTH))
+                        if pipe.x + pipe.PIPE_TOP.get_width() < 0:
+                            rem.append(pipe)
 
-                for r in rem:
-                    pipes.remove(r)
+                        if not pipe.passed and pipe.x < bird.x:
+                            pipe.passed = True
+                            add_pipe = True
 
+                    if add_pipe:
+                        score += 1
+                        pipes.append(new_pipe(WIN_WIDTH, spare))
 
-        if bird.y + bird_images[0].get_height() - 10 >= FLOOR:
-            break
+                    for r in rem:
+                        pipes.remove(r)
+                        spare.append(r)
 
-        draw_window(WIN, bird, pipes, base, score)
+            if bird.y + bird_images[0].get_height() - 10 >= FLOOR:
+                state = GAME_OVER
 
-    end_screen(WIN)
+        if state != GAME_OVER:
+            draw_window(win, bird, pipes, base, score)
 
-main(WIN)
 
-#change 1
 if __name__ == '__main__':
-    # Determine path to configuration file. This path manipulation is
-    # here so that the script will run successfully regardless of the
-    # current working directory.
-    local_dir = os.path.dirname(__file__)
-    config_path = os.path.join(local_dir, 'config-feedforward.txt')
-    run(config_path)
\ No newline at end of file
+    main(init_display())
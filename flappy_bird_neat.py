@@ -12,23 +12,50 @@ import os
 import time
 import neat
 import pickle
-pygame.font.init()  # init font
-
+import hashlib
+import multiprocessing
+import signal
+import multiprocessing.connection
+from multiprocessing import shared_memory, resource_tracker
+import tempfile
+import numpy as np
+from neat.activations import tanh_activation
+from neat.aggregations import sum_aggregation
+from dirty_rects import DirtyRenderer
+import assets
+
+# headless mode: no window, no fonts, no frame cap and no drawing, so training
+# runs as fast as the simulation allows. Enable with train --headless or FLAPPY_HEADLESS=1
+HEADLESS = os.environ.get("FLAPPY_HEADLESS", "0") not in ("", "0")
 
 WIN_WIDTH = 600
 WIN_HEIGHT = 800
 FLOOR = 730
-STAT_FONT = pygame.font.SysFont("comicsans", 50)
-END_FONT = pygame.font.SysFont("comicsans", 70)
+FPS = 100  # frame rate cap when drawing, 0 for no cap
+RENDER_EVERY = 1  # when drawing, draw 1 of every RENDER_EVERY frames. Up/down arrows double/halve it
+RENDER_FPS = 0  # when drawing, draw at most RENDER_FPS frames per second instead, 0 to use RENDER_EVERY
 DRAW_LINES = False
-
-WIN = pygame.display.set_mode((WIN_WIDTH, WIN_HEIGHT))
-pygame.display.set_caption("Flappy Bird")
-
-pipe_img = pygame.transform.scale2x(pygame.image.load(os.path.join("imgs","pipe.png")).convert_alpha())
-bg_img = pygame.transform.scale(pygame.image.load(os.path.join("imgs","bg.png")).convert_alpha(), (600, 900))
-bird_images = [pygame.transform.scale2x(pygame.image.load(os.path.join("imgs","bird" + str(x) + ".png"))) for x in range(1,4)]
-base_img = pygame.transform.scale2x(pygame.image.load(os.path.join("imgs","base.png")).convert_alpha())
+LOD_BIRDS = 0  # draw only the LOD_BIRDS fittest birds as sprites, 0 to draw all birds as sprites
+LOD_POINTS = True  # draw the other birds as dots, False to not draw them at all
+DIRTY_RECTS = False  # only redraw and update the parts of the window that changed
+ROTATED_COLLISION = False  # collide training birds using their rotated (drawn) mask
+SEED = None  # pipe courses are SEED + generation, None for a random course each generation
+FIXED_COURSE = False  # with a SEED, every generation flies course SEED
+
+# the window and fonts are made by init_display the first time something is
+# drawn, so the module can be imported without a display
+WIN = None
+STAT_FONT = END_FONT = None
+dirty = None  # DirtyRenderer of the window, made by draw_window when DIRTY_RECTS
+
+
+images = assets.load_images()  # scaled, from the memory mapped atlas
+pipe_img = images["pipe"]
+bg_img = images["bg"]
+bird_images = [images["bird" + str(x)] for x in range(1,4)]
+base_img = images["base"]
+POINT = pygame.Surface((4, 4))  # marker of the birds drawn without a sprite
+POINT.fill((255, 200, 0))
 
 gen = 0
 
@@ -92,10 +119,11 @@ class Bird:
             if self.tilt > -90:
                 self.tilt -= self.ROT_VEL
 
-    def draw(self, win):
+    def animate(self):
         """
-        draw the bird
-        :param win: pygame window or surface
+        advance the flapping animation and pick the current image.
+        Called from draw, or once per frame on its own when headless
+        so collisions use the same image either way
         :return: None
         """
         self.img_count += 1
@@ -118,16 +146,547 @@ class Bird:
             self.img = self.IMGS[1]
             self.img_count = self.ANIMATION_TIME*2
 
+    def draw(self, win):
+        """
+        draw the bird
+        :param win: pygame window or surface
+        :return: None
+        """
+        self.animate()
 
         # tilt the bird
-        blitRotateCenter(win, self.img, (self.x, self.y), self.tilt)
+        bird_sprites.blit(win, self.IMGS.index(self.img), self.tilt, (self.x, self.y))
 
     def get_mask(self):
         """
         gets the mask for the current image of the bird
         :return: None
         """
-        return pygame.mask.from_surface(self.img)
+        return bird_masks[self.IMGS.index(self.img)]
+
+
+def bird_tilts():
+    """
+    every tilt Bird.move can give a bird that starts with tilt 0
+    :return: sorted list of ints
+    """
+    tilts = set()
+    todo = [0]
+    while todo:
+        tilt = todo.pop()
+        if tilt in tilts:
+            continue
+        tilts.add(tilt)
+        todo.append(max(tilt, Bird.MAX_ROTATION))  # tilt up
+        if tilt > -90:
+            todo.append(tilt - Bird.ROT_VEL)  # tilt down
+    return sorted(tilts)
+
+
+class SpriteCache:
+    """
+    Every bird image rotated to every tilt, with the offset to blit
+    it at and its mask, so birds are drawn without rotating anything.
+    Sprites are numbered in the order they are added
+    """
+
+    def __init__(self, imgs, tilts):
+        """
+        rotate all images to all tilts
+        :param imgs: list of image surfaces
+        :param tilts: list of tilts (ints) in degrees
+        :return: None
+        """
+        self.imgs = imgs
+        self.sprites = []  # rotated surfaces
+        self.offsets = []  # from the topleft of the unrotated image to the topleft of the sprite
+        self.masks = []
+        self.ids = {}  # (image index, tilt): sprite number
+        for img in range(len(imgs)):
+            for tilt in tilts:
+                self.add(img, tilt)
+
+        # sprite numbers and offsets as arrays, for looking up many birds at once
+        self.offset_array = np.array(self.offsets)
+        self.min_tilt = min(tilts)
+        self.id_array = np.full((len(imgs), max(tilts) - self.min_tilt + 1), -1)
+        for (img, tilt), sprite in self.ids.items():
+            self.id_array[img, tilt - self.min_tilt] = sprite
+
+    def add(self, img, tilt):
+        """
+        rotate one image and add it to the cache, centred the same way as blitRotateCenter
+        :param img: image index (int)
+        :param tilt: degrees (int)
+        :return: sprite number (int)
+        """
+        image = self.imgs[img]
+        rotated = pygame.transform.rotate(image, tilt)
+        self.ids[img, tilt] = len(self.sprites)
+        self.sprites.append(rotated)
+        self.offsets.append((image.get_width()//2 - rotated.get_width()//2, image.get_height()//2 - rotated.get_height()//2))
+        self.masks.append(pygame.mask.from_surface(rotated))
+        return self.ids[img, tilt]
+
+    def get(self, img, tilt):
+        """
+        sprite number of an image at a tilt, rotating it first if it is not cached yet
+        :param img: image index (int)
+        :param tilt: degrees (int)
+        :return: sprite number (int)
+        """
+        sprite = self.ids.get((img, tilt))
+        if sprite is None:
+            sprite = self.add(img, tilt)
+        return sprite
+
+    def get_many(self, img, tilt):
+        """
+        sprite numbers of many birds, all tilts must come from bird_tilts
+        :param img: int array of image indices
+        :param tilt: int array of tilts
+        :return: int array of sprite numbers
+        """
+        return self.id_array[img, tilt - self.min_tilt]
+
+    def blit(self, win, img, tilt, topleft):
+        """
+        draw an image rotated around its center, same as blitRotateCenter
+        :param win: pygame window or surface
+        :param img: image index (int)
+        :param tilt: degrees (int)
+        :param topleft: the top left position of the unrotated image
+        :return: None
+        """
+        sprite = self.get(img, tilt)
+        rect = self.imgs[img].get_rect(topleft=topleft)
+        win.blit(self.sprites[sprite], (rect.x + self.offsets[sprite][0], rect.y + self.offsets[sprite][1]))
+
+    def blits(self, win, img, tilt, x, y):
+        """
+        draw many images with one Surface.blits call, same as blit for each.
+        All tilts must come from bird_tilts
+        :param win: pygame window or surface
+        :param img: int array of image indices
+        :param tilt: int array of tilts
+        :param x: left of the unrotated images (int)
+        :param y: array with the top of the unrotated images
+        :return: None
+        """
+        sprites = self.get_many(img, tilt)
+        # rounded half away from zero, like a Rect
+        y = np.where(y < 0, np.ceil(y - 0.5), np.floor(y + 0.5)).astype(int)
+        xs = (x + self.offset_array[sprites, 0]).tolist()
+        ys = (y + self.offset_array[sprites, 1]).tolist()
+        win.blits([(self.sprites[sprite], (sx, sy)) for sprite, sx, sy in zip(sprites.tolist(), xs, ys)], False)
+
+
+bird_masks = [pygame.mask.from_surface(img) for img in bird_images]
+bird_sprites = SpriteCache(bird_images, bird_tilts())
+
+
+class Flock:
+    """
+    A whole population of birds kept as numpy arrays (one entry
+    per bird) so every bird is moved in a single step. Follows
+    exactly the same rules as Bird.move and Bird.animate.
+    A bird keeps its index for the whole generation, so anything
+    else indexed by it (nets, genomes, fitness) stays in step with
+    it. The living birds are kept at the front of self.order
+    """
+    MAX_ROTATION = Bird.MAX_ROTATION
+    IMGS = Bird.IMGS
+    ROT_VEL = Bird.ROT_VEL
+    ANIMATION_TIME = Bird.ANIMATION_TIME
+    # image index for every value img_count can take, see Bird.animate
+    ANIMATION = np.array([0]*(ANIMATION_TIME + 1) + [1]*ANIMATION_TIME + [2]*ANIMATION_TIME + [1]*ANIMATION_TIME)
+    IMG_HEIGHTS = np.array([img.get_height() for img in IMGS])
+
+    def __init__(self, x, y, size):
+        """
+        Initialize the flock, every bird starts at the same spot
+        :param x: starting x pos of all birds (int), this never changes
+        :param y: starting y pos (int)
+        :param size: number of birds (int)
+        :return: None
+        """
+        self.x = x
+        self.y = np.full(size, y, dtype=float)
+        self.tilt = np.zeros(size, dtype=int)  # degrees to tilt
+        self.tick_count = np.zeros(size, dtype=int)
+        self.vel = np.zeros(size)
+        self.height = self.y.copy()
+        self.img_count = np.zeros(size, dtype=int)
+        self.img = np.zeros(size, dtype=int)  # index into IMGS
+
+        self.order = np.arange(size)  # living birds first, then the dead ones
+        self.slot = np.arange(size)  # where each bird is in order
+        self.n_alive = size
+
+    def __len__(self):
+        return len(self.y)
+
+    @property
+    def alive(self):
+        """
+        indices of the living birds
+        :return: int array
+        """
+        return self.order[:self.n_alive].copy()
+
+    def kill(self, ids):
+        """
+        remove birds from the living ones. Costs O(len(ids)), not
+        O(number of birds): the living birds from the end of the
+        living part move into the places of the killed ones
+        :param ids: indices of living birds
+        :return: None
+        """
+        ids = np.asarray(ids)
+        n_alive = self.n_alive - len(ids)
+
+        tail = self.order[n_alive:self.n_alive]
+        movers = tail[~np.isin(tail, ids)]
+        holes = self.slot[ids]
+        holes = holes[holes < n_alive]
+
+        self.order[holes] = movers
+        self.slot[movers] = holes
+        self.order[n_alive:self.n_alive] = ids
+        self.slot[ids] = np.arange(n_alive, self.n_alive)
+        self.n_alive = n_alive
+
+    def jump(self, ids):
+        """
+        make the birds jump
+        :param ids: indices of the birds that jump
+        :return: None
+        """
+        self.vel[ids] = -10.5
+        self.tick_count[ids] = 0
+        self.height[ids] = self.y[ids]
+
+    def move(self, ids):
+        """
+        make the birds move
+        :param ids: indices of the birds to move
+        :return: None
+        """
+        tick_count = self.tick_count[ids] + 1
+        self.tick_count[ids] = tick_count
+
+        # for downward acceleration
+        displacement = self.vel[ids]*(tick_count) + 0.5*(3)*(tick_count)**2
+
+        # terminal velocity
+        displacement[displacement >= 16] = 16
+        displacement[displacement < 0] -= 2
+
+        y = self.y[ids] + displacement
+        self.y[ids] = y
+
+        tilt = self.tilt[ids]
+        up = (displacement < 0) | (y < self.height[ids] + 50)
+        tilt[up & (tilt < self.MAX_ROTATION)] = self.MAX_ROTATION  # tilt up
+        tilt[~up & (tilt > -90)] -= self.ROT_VEL  # tilt down
+        self.tilt[ids] = tilt
+
+    def animate(self, ids):
+        """
+        advance the flapping animation of the birds
+        :param ids: indices of the birds to animate
+        :return: None
+        """
+        img_count = self.img_count[ids] + 1
+        img_count[img_count == self.ANIMATION_TIME*4 + 1] = 0
+        img = self.ANIMATION[img_count]
+
+        # so when bird is nose diving it isn't flapping
+        diving = self.tilt[ids] <= -80
+        img[diving] = 1
+        img_count[diving] = self.ANIMATION_TIME*2
+
+        self.img_count[ids] = img_count
+        self.img[ids] = img
+
+    def draw(self, win, ids):
+        """
+        draw the birds, without advancing their animation
+        :param win: pygame window or surface
+        :param ids: indices of the birds to draw
+        :return: None
+        """
+        bird_sprites.blits(win, self.img[ids], self.tilt[ids], self.x, self.y[ids])
+
+    def draw_points(self, win, ids):
+        """
+        draw the birds as a small dot at their centre, much cheaper than draw
+        :param win: pygame window or surface
+        :param ids: indices of the birds to draw
+        :return: None
+        """
+        x = self.x + self.IMGS[0].get_width() // 2 - POINT.get_width() // 2
+        ys = (self.y[ids] + self.IMG_HEIGHTS[self.img[ids]] // 2 - POINT.get_height() // 2).astype(int).tolist()
+        win.blits([(POINT, (x, y)) for y in ys], False)
+
+    def collide(self, pipe, ids):
+        """
+        pixel perfect collision of the birds with a pipe, same as Pipe.collide
+        :param pipe: Pipe object
+        :param ids: indices of the birds to check
+        :return: bool array, True for every bird in ids that hits the pipe
+        """
+        if ROTATED_COLLISION:
+            # the rotated mask sits where the sprite is drawn, pygame rounds halves away from 0 there
+            img = bird_sprites.get_many(self.img[ids], self.tilt[ids])
+            y = self.y[ids]
+            x = self.x + bird_sprites.offset_array[img, 0]
+            y = bird_sprites.offset_array[img, 1] + np.where(y < 0, np.ceil(y - 0.5), np.floor(y + 0.5)).astype(int)
+            table = get_rotated_collision_table()
+        else:
+            img = self.img[ids]
+            y = np.rint(self.y[ids]).astype(int)  # rounds like round() does
+            x = self.x
+            table = collision_table
+        dx = pipe.x - x
+        return table.overlap(img, 0, dx, pipe.top - y) | table.overlap(img, 1, dx, pipe.bottom - y)
+
+    def off_screen(self, ids):
+        """
+        find the birds that hit the floor or flew over the top of the screen
+        :param ids: indices of the birds to check
+        :return: bool array, True for every bird in ids that is out
+        """
+        y = self.y[ids]
+        return (y + self.IMG_HEIGHTS[self.img[ids]] - 10 >= FLOOR) | (y < -50)
+
+
+class NetworkBatch:
+    """
+    The neural networks of a whole generation compiled into padded
+    numpy arrays, so all birds can be activated with one call.
+    Each network gets a row of value slots: its inputs, then one slot
+    per node it evaluates (in FeedForwardNetwork order) and a last
+    slot that always stays 0. Links are summed in the same order as
+    FeedForwardNetwork.activate does it, so the outputs only differ
+    from it in the last bit numpy's tanh may round differently
+    """
+
+    def __init__(self, nets):
+        """
+        compile a list of FeedForwardNetworks
+        :param nets: list of neat.nn.FeedForwardNetwork
+        :return: None
+        """
+        n_inputs = len(nets[0].input_nodes)
+        n_outputs = len(nets[0].output_nodes)
+        n_steps = max(len(net.node_evals) for net in nets)
+        n_links = max([len(links) for net in nets for node, act, agg, bias, response, links in net.node_evals] + [0])
+        zero = n_inputs + n_steps  # slot that is never written
+
+        # padding steps add 0 * (slot that is always 0) and write to their own unused slot
+        self.src = np.full((len(nets), n_steps, n_links), zero)
+        self.weight = np.zeros((len(nets), n_steps, n_links))
+        self.bias = np.zeros((len(nets), n_steps))
+        self.response = np.zeros((len(nets), n_steps))
+        self.out = np.full((len(nets), n_outputs), zero)
+        self.n_slots = zero + 1
+        self.n_inputs = n_inputs
+
+        for j, net in enumerate(nets):
+            slot = {key: i for i, key in enumerate(net.input_nodes)}
+            for s, (node, act_func, agg_func, bias, response, links) in enumerate(net.node_evals):
+                if act_func is not tanh_activation or agg_func is not sum_aggregation:
+                    raise ValueError("NetworkBatch only supports tanh activation with sum aggregation")
+                self.bias[j, s] = bias
+                self.response[j, s] = response
+                for l, (i, w) in enumerate(links):
+                    self.src[j, s, l] = slot[i]
+                    self.weight[j, s, l] = w
+                slot[node] = n_inputs + s
+            for o, key in enumerate(net.output_nodes):
+                self.out[j, o] = slot.get(key, zero)  # an output without inputs stays 0
+
+    ARRAYS = ("src", "weight", "bias", "response", "out")  # what pack copies
+
+    def __len__(self):
+        return len(self.bias)
+
+    def nbytes(self):
+        """
+        :return: bytes pack needs (int)
+        """
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    def pack(self, buf):
+        """
+        copy the arrays one after the other into a buffer, e.g. of a
+        multiprocessing.shared_memory block
+        :param buf: writable buffer of at least nbytes()
+        :return: layout to give unpack, a small tuple that is cheap to pickle
+        """
+        arrays = []
+        offset = 0
+        for name in self.ARRAYS:
+            array = getattr(self, name)
+            np.ndarray(array.shape, array.dtype, buffer=buf, offset=offset)[...] = array
+            arrays.append((name, array.dtype.str, array.shape, offset))
+            offset += array.nbytes
+        return self.n_inputs, self.n_slots, tuple(arrays)
+
+    @classmethod
+    def unpack(cls, buf, layout):
+        """
+        networks packed into a buffer by pack, without copying them
+        :param buf: the buffer
+        :param layout: what pack returned
+        :return: NetworkBatch whose arrays are views of buf
+        """
+        batch = cls.__new__(cls)
+        batch.n_inputs, batch.n_slots, arrays = layout
+        for name, dtype, shape, offset in arrays:
+            setattr(batch, name, np.ndarray(shape, dtype, buffer=buf, offset=offset))
+        return batch
+
+    def rows(self, start, stop):
+        """
+        some of the networks, without copying them
+        :param start: index of the first network
+        :param stop: index after the last network
+        :return: NetworkBatch whose arrays are views of these arrays
+        """
+        batch = NetworkBatch.__new__(NetworkBatch)
+        batch.n_inputs = self.n_inputs
+        batch.n_slots = self.n_slots
+        for name in self.ARRAYS:
+            setattr(batch, name, getattr(self, name)[start:stop])
+        return batch
+
+    def activate(self, ids, inputs):
+        """
+        activate the networks of some of the birds at once
+        :param ids: indices of the networks to activate
+        :param inputs: array of shape (len(ids), number of inputs)
+        :return: array of shape (len(ids), number of outputs)
+        """
+        rows = np.arange(len(ids))
+        values = np.zeros((len(ids), self.n_slots))
+        values[:, :self.n_inputs] = inputs
+
+        src = self.src[ids]
+        weight = self.weight[ids]
+        bias = self.bias[ids]
+        response = self.response[ids]
+        for s in range(src.shape[1]):
+            total = np.zeros(len(ids))
+            for l in range(src.shape[2]):
+                total = total + values[rows, src[:, s, l]] * weight[:, s, l]
+            # same as neat.activations.tanh_activation
+            z = np.clip(2.5 * (bias[:, s] + response[:, s] * total), -60.0, 60.0)
+            values[:, self.n_inputs + s] = np.tanh(z)
+
+        return values[rows[:, None], self.out[ids]]
+
+
+def phenotype_key(net):
+    """
+    canonical form of a network: every node is described by its bias,
+    response, functions and the (description, weight) of its inputs,
+    so node ids and nodes the outputs do not use make no difference.
+    Genomes that differ only in disabled genes or in such details get
+    the same key. The inputs stay in their order, float sums depend on
+    it and networks with the same key must give the same outputs
+    :param net: neat.nn.FeedForwardNetwork
+    :return: str
+    """
+    node = {key: "in %d" % key for key in net.input_nodes}
+    for key, act_func, agg_func, bias, response, links in net.node_evals:
+        inputs = [(node[i], w) for i, w in links]
+        node[key] = hashlib.sha1(repr((act_func.__name__, agg_func.__name__, bias, response, inputs)).encode()).hexdigest()
+    return hashlib.sha1(repr([node.get(key) for key in net.output_nodes]).encode()).hexdigest()
+
+
+def unique_networks(nets):
+    """
+    drop the networks that behave the same as an earlier one
+    :param nets: list of neat.nn.FeedForwardNetwork
+    :return: (list of unique networks, for every network the index of
+             its unique network)
+    """
+    unique = []
+    index = []
+    rows = {}  # phenotype key: index in unique
+    for net in nets:
+        key = phenotype_key(net)
+        if key not in rows:
+            rows[key] = len(unique)
+            unique.append(net)
+        index.append(rows[key])
+    return unique, index
+
+
+def compile_networks(genomes, config, dedup=True):
+    """
+    compile the networks of some genomes into a NetworkBatch. Birds
+    with the same network fly the same, so each network is in it once
+    :param genomes: list of (genome_id, genome)
+    :param config: neat config
+    :param dedup: False to give every genome its own row, e.g. when
+                  every genome has to be drawn as a bird
+    :return: (NetworkBatch, for every genome its row in the batch)
+    """
+    nets = [neat.nn.FeedForwardNetwork.create(genome, config) for genome_id, genome in genomes]
+    if not dedup:
+        return NetworkBatch(nets), list(range(len(nets)))
+    unique, index = unique_networks(nets)
+    report("Unique networks: %d of %d" % (len(unique), len(genomes)))
+    return NetworkBatch(unique), index
+
+
+class Course:
+    """
+    The heights of the pipes of a game, picked up front from a seed
+    so every world flying the course sees the same pipes. Saved to a
+    .npy file the heights are memory mapped, and pickling a course
+    only sends the file name
+    """
+    LENGTH = 10000  # pipes, after these the course starts over
+
+    def __init__(self, seed, length=LENGTH, path=None):
+        """
+        pick the pipe heights
+        :param seed: int
+        :param length: number of pipes (int)
+        :param path: .npy file to save the heights in and map them from, or None to keep them in memory
+        :return: None
+        """
+        self.seed = seed
+        self.path = path
+        self.heights = np.random.default_rng(seed).integers(50, 450, size=length, dtype=np.int16)
+        if path is not None:
+            np.save(path, self.heights)
+            self.heights = np.load(path, mmap_mode="r")
+
+    def __len__(self):
+        return len(self.heights)
+
+    def __getitem__(self, index):
+        """
+        height of pipe number index
+        :param index: int
+        :return: int
+        """
+        return int(self.heights[index % len(self.heights)])
+
+    def __getstate__(self):
+        if self.path is None:
+            return self.__dict__
+        return {"seed": self.seed, "path": self.path, "heights": None}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.heights is None:
+            self.heights = np.load(self.path, mmap_mode="r")
 
 
 class Pipe():
@@ -136,12 +695,20 @@ class Pipe():
     """
     GAP = 160
     VEL = 5
+    # shared by all pipes, a pipe only holds its position
+    PIPE_TOP = pygame.transform.flip(pipe_img, False, True)
+    PIPE_BOTTOM = pipe_img
+    TOP_MASK = pygame.mask.from_surface(PIPE_TOP)
+    BOTTOM_MASK = pygame.mask.from_surface(PIPE_BOTTOM)
+
+    __slots__ = ("x", "height", "top", "bottom", "passed")
 
-    def __init__(self, x):
+    def __init__(self, x, course=None, index=0):
         """
         initialize pipe object
         :param x: int
-        :param y: int
+        :param course: Course to take the height from, or None for a random height
+        :param index: number of the pipe in the course (int)
         :return" None
         """
         self.x = x
@@ -151,19 +718,21 @@ class Pipe():
         self.top = 0
         self.bottom = 0
 
-        self.PIPE_TOP = pygame.transform.flip(pipe_img, False, True)
-        self.PIPE_BOTTOM = pipe_img
-
         self.passed = False
 
-        self.set_height()
+        self.set_height(course, index)
 
-    def set_height(self):
+    def set_height(self, course=None, index=0):
         """
         set the height of the pipe, from the top of the screen
+        :param course: Course to take the height from, or None for a random height
+        :param index: number of the pipe in the course (int)
         :return: None
         """
-        self.height = random.randrange(50, 450)
+        if course is None:
+            self.height = random.randrange(50, 450)
+        else:
+            self.height = int(course[index])
         self.top = self.height - self.PIPE_TOP.get_height()
         self.bottom = self.height + self.GAP
 
@@ -193,8 +762,8 @@ class Pipe():
         :return: Bool
         """
         bird_mask = bird.get_mask()
-        top_mask = pygame.mask.from_surface(self.PIPE_TOP)
-        bottom_mask = pygame.mask.from_surface(self.PIPE_BOTTOM)
+        top_mask = self.TOP_MASK
+        bottom_mask = self.BOTTOM_MASK
         top_offset = (self.x - bird.x, self.top - round(bird.y))
         bottom_offset = (self.x - bird.x, self.bottom - round(bird.y))
 
@@ -206,6 +775,87 @@ class Pipe():
 
         return False
 
+class CollisionTable:
+    """
+    Pixel perfect collision between every bird image and the top
+    and bottom pipe, worked out once for every offset where the masks
+    can touch. A lookup gives exactly what mask.overlap would give
+    """
+    VERSION = 1  # of the layout of bits, change it to not load tables cached by other versions
+
+    def __init__(self, bird_masks, pipe_masks, cache=None):
+        """
+        :param bird_masks: list of bird masks
+        :param pipe_masks: list of pipe masks (top, bottom)
+        :param cache: name to keep the table under in the asset cache,
+                      None to always build it
+        :return: None
+        """
+        self.pipe_sizes = np.array([mask.get_size() for mask in pipe_masks])
+        self.width = max(b.get_size()[0] for b in bird_masks) + self.pipe_sizes[:, 0].max() - 1
+        self.height = max(b.get_size()[1] for b in bird_masks) + self.pipe_sizes[:, 1].max() - 1
+        if cache is None:
+            self.bits = self.build(bird_masks, pipe_masks)
+        else:
+            # the masks depend on more than the images, e.g. the tilts of
+            # the rotated sprites, so the cache entry is tied to the masks
+            masks = [(mask.get_size(), mask.count(), mask.centroid()) for mask in bird_masks + pipe_masks]
+            shape = (len(bird_masks), len(pipe_masks), self.height, (self.width + 7) // 8)
+            self.bits = assets.cached_array(cache, lambda: self.build(bird_masks, pipe_masks), (self.VERSION, shape, masks))
+
+    def build(self, bird_masks, pipe_masks):
+        """
+        build the table with Mask.convolve: bit (x, y) of a.convolve(b)
+        is set when b overlaps a at offset (x - b_width + 1, y - b_height + 1)
+        :param bird_masks: list of bird masks
+        :param pipe_masks: list of pipe masks (top, bottom)
+        :return: uint8 array, one row of bits per y offset, packed 8 x offsets to a byte
+        """
+        bits = np.zeros((len(bird_masks), len(pipe_masks), self.height, (self.width + 7) // 8), dtype=np.uint8)
+        for b, bird_mask in enumerate(bird_masks):
+            for p, pipe_mask in enumerate(pipe_masks):
+                conv = bird_mask.convolve(pipe_mask)
+                w, h = conv.get_size()
+                hits = np.zeros((self.height, self.width), dtype=bool)
+                hits[:h, :w] = pygame.surfarray.array_red(conv.to_surface()).T > 0
+                bits[b, p] = np.packbits(hits, axis=1)
+        return bits
+
+    def overlap(self, img, pipe, dx, dy):
+        """
+        same as bird_mask.overlap(pipe_mask, (dx, dy)) is not None
+        :param img: bird image index (int or int array)
+        :param pipe: pipe image index, 0 for the top pipe and 1 for the bottom
+        :param dx: x offset of the pipe from the bird (int or int array)
+        :param dy: y offset of the pipe from the bird (int or int array)
+        :return: bool array
+        """
+        x = np.asarray(dx) + self.pipe_sizes[pipe, 0] - 1
+        y = np.asarray(dy) + self.pipe_sizes[pipe, 1] - 1
+        inside = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+        x = np.where(inside, x, 0)
+        y = np.where(inside, y, 0)
+        bit = (self.bits[img, pipe, y, x >> 3] >> (7 - (x & 7))) & 1
+        return inside & (bit == 1)
+
+
+pipe_masks = [Pipe.TOP_MASK, Pipe.BOTTOM_MASK]
+collision_table = CollisionTable(bird_masks, pipe_masks, "collision")
+rotated_collision_table = None  # built the first time ROTATED_COLLISION is used
+
+
+def get_rotated_collision_table():
+    """
+    the collision table of the rotated bird sprites, built (or loaded
+    from the asset cache) the first time it is needed
+    :return: CollisionTable
+    """
+    global rotated_collision_table
+    if rotated_collision_table is None:
+        rotated_collision_table = CollisionTable(bird_sprites.masks, pipe_masks, "rotated_collision")
+    return rotated_collision_table
+
+
 class Base:
     """
     Represnts the moving floor of the game
@@ -261,105 +911,495 @@ def blitRotateCenter(surf, image, topleft, angle):
 
     surf.blit(rotated_image, new_rect.topleft)
 
-def draw_window(win, birds, pipes, base, score, gen, pipe_ind):
+class HUD:
+    """
+    Text labels of the window, each rendered again only when its
+    value changes
+    """
+
+    def __init__(self, font, color=(255,255,255)):
+        """
+        :param font: pygame font to render with
+        :param color: text color
+        :return: None
+        """
+        self.font = font
+        self.color = color
+        self.labels = {}  # name: (value, rendered surface)
+
+    def label(self, name, value):
+        """
+        rendered "name value" text
+        :param name: text in front of the value (str)
+        :param value: value shown after it
+        :return: pygame surface
+        """
+        cached = self.labels.get(name)
+        if cached is None or cached[0] != value:
+            cached = (value, self.font.render(name + str(value), 1, self.color))
+            self.labels[name] = cached
+        return cached[1]
+
+
+hud = HUD(STAT_FONT)
+
+
+def init_display():
+    """
+    open the window, load the fonts and convert the images for fast
+    blitting, the first time it is called
+    :return: the window surface
+    """
+    global WIN, STAT_FONT, END_FONT, pipe_img, bg_img, base_img, bird_images
+    if WIN is not None:
+        return WIN
+
+    STAT_FONT = assets.load_font("comicsans", 50)
+    END_FONT = assets.load_font("comicsans", 70)
+    hud.font = STAT_FONT
+
+    WIN = pygame.display.set_mode((WIN_WIDTH, WIN_HEIGHT))
+    pygame.display.set_caption("Flappy Bird")
+
+    pipe_img = pipe_img.convert_alpha()
+    bg_img = bg_img.convert_alpha()
+    base_img = base_img.convert_alpha()
+    bird_images = [img.convert_alpha() for img in bird_images]
+    Pipe.PIPE_TOP = Pipe.PIPE_TOP.convert_alpha()
+    Pipe.PIPE_BOTTOM = pipe_img
+    Base.IMG = base_img
+    Bird.IMGS = Flock.IMGS = bird_sprites.imgs = bird_images
+    bird_sprites.sprites = [sprite.convert_alpha() for sprite in bird_sprites.sprites]
+    return WIN
+
+
+def draw_window(win, flock, pipes, base, score, gen, pipe_ind, fitness=None):
     """
     draws the windows for the main game loop
     :param win: pygame window surface
-    :param bird: a Bird object
+    :param flock: the Flock of birds, only living birds are drawn
     :param pipes: List of pipes
     :param score: score of the game (int)
     :param gen: current generation
     :param pipe_ind: index of closest pipe
+    :param fitness: fitness of every bird, to pick the birds drawn as
+                    sprites when there are more than LOD_BIRDS
     :return: None
     """
+    global dirty
     if gen == 0:
         gen = 1
-    win.blit(bg_img, (0,0))
+    if DIRTY_RECTS:
+        if dirty is None or dirty.win is not win:
+            dirty = DirtyRenderer(win, bg_img)
+        screen = dirty
+        screen.begin()
+    else:
+        screen = win
+        win.blit(bg_img, (0,0))
 
     for pipe in pipes:
-        pipe.draw(win)
-
-    base.draw(win)
-    for bird in birds:
-        # draw lines from bird to pipe
-        if DRAW_LINES:
+        pipe.draw(screen)
+
+    base.draw(screen)
+    alive = flock.alive
+    # draw lines from bird to pipe
+    if DRAW_LINES:
+        for i in alive:
+            img = flock.IMGS[flock.img[i]]
             try:
-                pygame.draw.line(win, (255,0,0), (bird.x+bird.img.get_width()/2, bird.y + bird.img.get_height()/2), (pipes[pipe_ind].x + pipes[pipe_ind].PIPE_TOP.get_width()/2, pipes[pipe_ind].height), 5)
-                pygame.draw.line(win, (255,0,0), (bird.x+bird.img.get_width()/2, bird.y + bird.img.get_height()/2), (pipes[pipe_ind].x + pipes[pipe_ind].PIPE_BOTTOM.get_width()/2, pipes[pipe_ind].bottom), 5)
+                top = pygame.draw.line(win, (255,0,0), (flock.x+img.get_width()/2, flock.y[i] + img.get_height()/2), (pipes[pipe_ind].x + pipes[pipe_ind].PIPE_TOP.get_width()/2, pipes[pipe_ind].height), 5)
+                bottom = pygame.draw.line(win, (255,0,0), (flock.x+img.get_width()/2, flock.y[i] + img.get_height()/2), (pipes[pipe_ind].x + pipes[pipe_ind].PIPE_BOTTOM.get_width()/2, pipes[pipe_ind].bottom), 5)
+                if screen is not win:
+                    screen.mark(top.union(bottom))
             except:
                 pass
-        # draw bird
-        bird.draw(win)
+    # draw birds, with many birds only the fittest get a sprite
+    if LOD_BIRDS and fitness is not None and len(alive) > LOD_BIRDS:
+        fittest = np.argpartition(-fitness[alive], LOD_BIRDS - 1)[:LOD_BIRDS]
+        rest = np.ones(len(alive), dtype=bool)
+        rest[fittest] = False
+        if LOD_POINTS:
+            flock.draw_points(screen, alive[rest])
+        flock.draw(screen, alive[fittest])
+    else:
+        flock.draw(screen, alive)
 
     # score
-    score_label = STAT_FONT.render("Score: " + str(score),1,(255,255,255))
-    win.blit(score_label, (WIN_WIDTH - score_label.get_width() - 15, 10))
+    score_label = hud.label("Score: ", score)
+    screen.blit(score_label, (WIN_WIDTH - score_label.get_width() - 15, 10))
 
     # generations
-    score_label = STAT_FONT.render("Gens: " + str(gen-1),1,(255,255,255))
-    win.blit(score_label, (10, 10))
+    score_label = hud.label("Gens: ", gen-1)
+    screen.blit(score_label, (10, 10))
 
     # alive
-    score_label = STAT_FONT.render("Alive: " + str(len(birds)),1,(255,255,255))
-    win.blit(score_label, (10, 50))
+    score_label = hud.label("Alive: ", len(alive))
+    screen.blit(score_label, (10, 50))
 
-    pygame.display.update()
+    if screen is win:
+        pygame.display.update()
+    else:
+        screen.update()
 
 
-def main(genomes, config):
+class Budget:
     """
-    runs the simulation of the current population of
-    birds and sets their fitness based on the distance they
-    reach in the game.
+    Limits on how long one generation may run, so a population that
+    stops dying still finishes its generations. None means no limit
     """
-    global WIN, gen
-    win = WIN
-    gen += 1
 
-    # start by creating lists holding the genome itself, the
-    # neural network associated with the genome and the
-    # bird object that uses that network to play
-    nets = []
-    birds = []
-    ge = []
-    for genome_id, genome in genomes:
-        genome.fitness = 0  # start with fitness level of 0
-        net = neat.nn.FeedForwardNetwork.create(genome, config)
-        nets.append(net)
-        birds.append(Bird(230,350))
-        ge.append(genome)
+    def __init__(self, max_frames=None, max_seconds=None, max_score=None):
+        """
+        :param max_frames: stop after this many frames (int)
+        :param max_seconds: stop after this much wall clock time (float)
+        :param max_score: stop once this many pipes are passed (int)
+        :return: None
+        """
+        self.max_frames = max_frames
+        self.max_seconds = max_seconds
+        self.max_score = max_score
+
+    def deadline(self, start):
+        """
+        when a generation that starts at start runs out of time
+        :param start: time.time() when the generation started
+        :return: time.time() to stop at (float), or None without max_seconds
+        """
+        if self.max_seconds is None:
+            return None
+        return start + self.max_seconds
+
+    def check(self, frames, deadline, score):
+        """
+        check whether the generation has used up its budget
+        :param frames: frames simulated so far (int)
+        :param deadline: time.time() to stop at, see deadline, or None
+        :param score: pipes passed so far (int)
+        :return: why the generation has to stop (str), or None to go on
+        """
+        if self.max_frames is not None and frames >= self.max_frames:
+            return "reached max frames (%d)" % self.max_frames
+        if self.max_score is not None and score >= self.max_score:
+            return "reached max score (%d)" % self.max_score
+        if deadline is not None and time.time() >= deadline:
+            return "ran out of time (%g s)" % self.max_seconds
+        return None
+
+
+BUDGET = Budget()
+reporters = None  # neat ReporterSet of the running population
+
+
+class FitnessCache:
+    """
+    Fitness of the genomes of the last generation, by a hash of their
+    genes, the course they flew and the budget. Elites are carried
+    into the next generation unchanged, so when that generation flies
+    the same course (FIXED_COURSE) they need not be simulated again.
+    Birds do not affect each other, so a cached fitness is exactly
+    what simulating again would give. Games limited by wall clock
+    time are not cached, their fitness depends on how fast they ran
+    """
+
+    def __init__(self):
+        """
+        :return: None
+        """
+        self.fitness = {}  # key: fitness
+        self.lookups = 0
+        self.hits = 0
+
+    @staticmethod
+    def key(genome, seed, budget):
+        """
+        hash of everything the fitness of a genome depends on
+        :param genome: neat genome
+        :param seed: seed of the course (int)
+        :param budget: Budget of the game
+        :return: str, or None when the fitness can not be cached
+        """
+        if budget.max_seconds is not None:
+            return None
+        nodes = sorted((key, node.bias, node.response, node.activation, node.aggregation) for key, node in genome.nodes.items())
+        connections = sorted((key, conn.weight, conn.enabled) for key, conn in genome.connections.items())
+        return hashlib.sha1(repr((nodes, connections, seed, budget.max_frames, budget.max_score)).encode()).hexdigest()
+
+    def lookup(self, genomes, seed, budget):
+        """
+        set the fitness of the genomes that are in the cache
+        :param genomes: list of (genome_id, genome)
+        :param seed: seed of the course (int)
+        :param budget: Budget of the game
+        :return: list of (genome_id, genome) that still have to be simulated
+        """
+        todo = []
+        for genome_id, genome in genomes:
+            fitness = self.fitness.get(self.key(genome, seed, budget))
+            if fitness is None:
+                todo.append((genome_id, genome))
+            else:
+                genome.fitness = fitness
+        self.lookups += len(genomes)
+        self.hits += len(genomes) - len(todo)
+        report("Fitness cache: %d of %d genomes cached, %.1f%% hit rate" % (
+            len(genomes) - len(todo), len(genomes), 100 * self.hits / max(self.lookups, 1)))
+        return todo
+
+    def store(self, genomes, seed, budget):
+        """
+        remember the fitness of a generation, forgetting the one before
+        :param genomes: list of (genome_id, genome) with their fitness set
+        :param seed: seed of the course (int)
+        :param budget: Budget of the game
+        :return: None
+        """
+        self.fitness = {}
+        for genome_id, genome in genomes:
+            key = self.key(genome, seed, budget)
+            if key is not None:
+                self.fitness[key] = genome.fitness
+
+
+FITNESS_CACHE = None  # FitnessCache to skip genomes that flew the same course before, None to simulate all
+
+
+def evaluate_cached(genomes, seed, fly):
+    """
+    set the fitness of a generation, simulating only the genomes that
+    are not in FITNESS_CACHE
+    :param genomes: list of (genome_id, genome)
+    :param seed: seed of the course the generation flies (int)
+    :param fly: function that simulates a list of (genome_id, genome),
+                never empty, and sets their fitness
+    :return: None
+    """
+    if FITNESS_CACHE is None:
+        fly(genomes)
+        return
+    todo = FITNESS_CACHE.lookup(genomes, seed, BUDGET)
+    if todo:
+        fly(todo)
+    FITNESS_CACHE.store(genomes, seed, BUDGET)
+
+
+class PhaseTimer:
+    """
+    Times the phases of every frame of simulate. Each phase gets
+    one duration per frame, so totals and percentiles can be
+    reported per generation
+    """
+    PHASES = ("events", "move", "activate", "pipes", "cull", "draw")
+
+    def __init__(self):
+        """
+        :return: None
+        """
+        self.times = {}
+        self.reset()
+
+    def reset(self):
+        """
+        forget all durations, at the start of a generation
+        :return: None
+        """
+        self.times = {phase: [] for phase in self.PHASES}
+
+    def lap(self, phase, start):
+        """
+        record a phase that started at start and ends now
+        :param phase: name from PHASES
+        :param start: time.perf_counter() when the phase started
+        :return: time.perf_counter() now, the start of the next phase
+        """
+        now = time.perf_counter()
+        self.times[phase].append(now - start)
+        return now
+
+    def merge(self, times):
+        """
+        add the durations recorded by another timer, e.g. in a worker process
+        :param times: the other timer's times
+        :return: None
+        """
+        for phase, durations in times.items():
+            self.times[phase].extend(durations)
+
+    def stats(self):
+        """
+        totals and per frame percentiles of every phase, in milliseconds
+        :return: {phase: {"total": ms, "p50": ms, "p95": ms, "p99": ms}}
+        """
+        stats = {}
+        for phase, durations in self.times.items():
+            ms = np.array(durations) * 1000 if durations else np.zeros(1)
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            stats[phase] = {"total": float(ms.sum()), "p50": float(p50), "p95": float(p95), "p99": float(p99)}
+        return stats
+
+
+class TimingReporter(neat.reporting.BaseReporter):
+    """
+    NEAT reporter that prints how long each phase of a frame took
+    during the generation, next to what StdOutReporter prints
+    """
+
+    def __init__(self, timer):
+        """
+        :param timer: the PhaseTimer simulate records into (TIMER)
+        :return: None
+        """
+        self.timer = timer
+        self.history = []  # stats of every generation
+
+    def start_generation(self, generation):
+        self.timer.reset()
+
+    def post_evaluate(self, config, population, species, best_genome):
+        stats = self.timer.stats()
+        self.history.append(stats)
+        frames = max(len(durations) for durations in self.timer.times.values())
+        print("Frame phases over {0} frames (ms):  {1:>9} {2:>7} {3:>7} {4:>7}".format(frames, "total", "p50", "p95", "p99"))
+        for phase in self.timer.PHASES:
+            print("   {0:<10} {1:>32.1f} {2:>7.3f} {3:>7.3f} {4:>7.3f}".format(
+                phase, stats[phase]["total"], stats[phase]["p50"], stats[phase]["p95"], stats[phase]["p99"]))
+
+
+TIMER = None  # PhaseTimer to time the frames of simulate with, None to not time anything
+
+
+def report(message):
+    """
+    pass a message on to the NEAT reporters, if training is running
+    :param message: str
+    :return: None
+    """
+    if reporters is not None:
+        reporters.info(message)
+
+
+def course_seed(generation):
+    """
+    seed of the pipe course of a generation, all birds of
+    a generation fly the same course
+    :param generation: generation number (int)
+    :return: int
+    """
+    if SEED is None:
+        return random.randrange(2**32)
+    if FIXED_COURSE:
+        return SEED
+    return SEED + generation
+
 
+def change_render_every(key):
+    """
+    change how many frames are simulated per drawn frame with the
+    arrow keys: up doubles RENDER_EVERY, down halves it. Either
+    one switches from RENDER_FPS to RENDER_EVERY
+    :param key: pygame key of a KEYDOWN event
+    :return: None
+    """
+    global RENDER_EVERY, RENDER_FPS
+    if key == pygame.K_UP:
+        RENDER_EVERY *= 2
+    elif key == pygame.K_DOWN:
+        RENDER_EVERY = max(1, RENDER_EVERY // 2)
+    else:
+        return
+    RENDER_FPS = 0
+    pygame.display.set_caption("Flappy Bird - drawing 1 of %d frames" % RENDER_EVERY)
+
+
+def simulate(nets, course, draw=False, budget=None, deadline=None):
+    """
+    plays one game with a bird for every network until all
+    birds are dead. Birds do not affect each other, so a bird
+    scores the same whichever other birds fly with it
+    :param nets: NetworkBatch, bird number i is played by network i
+    :param course: Course with the pipe heights
+    :param draw: draw to WIN, 1 of RENDER_EVERY frames (or RENDER_FPS
+                 frames per second) at a capped frame rate
+    :param budget: Budget to stop early at, defaults to BUDGET
+    :param deadline: time.time() the generation has to stop at, defaults
+                     to max_seconds of the budget from now
+    :return: array with the fitness of every bird and why the game
+             stopped before all birds died (str) or None
+    """
+    if budget is None:
+        budget = BUDGET
+    if deadline is None:
+        deadline = budget.deadline(time.time())
+    if draw:
+        init_display()
+    stop = None
+    frames = 0
+
+    timer = TIMER
+    flock = Flock(230, 350, len(nets))
+    fitness = np.zeros(len(nets))
     base = Base(FLOOR)
-    pipes = [Pipe(700)]
+    pipes = [Pipe(700, course, 0)]
+    n_pipes = 1
     score = 0
 
     clock = pygame.time.Clock()
+    last_render = 0
 
     run = True
-    while run and len(birds) > 0:
-        clock.tick(100)
-
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                run = False
-                pygame.quit()
-                quit()
-                break
+    while run and flock.n_alive > 0:
+        if timer is not None:
+            t = time.perf_counter()
+
+        # only the frames that are drawn are capped, the frames in
+        # between are simulated at full speed. Events are still pumped
+        # now and then so the window stays responsive
+        render = False
+        if draw:
+            if RENDER_FPS:
+                now = time.time()
+                render = now - last_render >= 1 / RENDER_FPS
+                if render:
+                    last_render = now
+            else:
+                render = frames % RENDER_EVERY == 0
+
+        if draw and (render or frames % 100 == 0):
+            if render:
+                clock.tick(FPS)
+
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    run = False
+                    pygame.quit()
+                    quit()
+                    break
+                if event.type == pygame.KEYDOWN:
+                    change_render_every(event.key)
+
+        if timer is not None:
+            t = timer.lap("events", t)
+
+        alive = flock.alive
 
         pipe_ind = 0
-        if len(birds) > 0:
-            if len(pipes) > 1 and birds[0].x > pipes[0].x + pipes[0].PIPE_TOP.get_width():  # determine whether to use the first or second
-                pipe_ind = 1                                                                 # pipe on the screen for neural network input
+        if len(pipes) > 1 and flock.x > pipes[0].x + pipes[0].PIPE_TOP.get_width():  # determine whether to use the first or second
+            pipe_ind = 1                                                             # pipe on the screen for neural network input
+
+        fitness[alive] += 0.1  # give each bird a fitness of 0.1 for each frame it stays alive
+        flock.move(alive)
 
-        for x, bird in enumerate(birds):  # give each bird a fitness of 0.1 for each frame it stays alive
-            ge[x].fitness += 0.1
-            bird.move()
+        if timer is not None:
+            t = timer.lap("move", t)
 
-            # send bird location, top pipe location and bottom pipe location and determine from network whether to jump or not
-            output = nets[birds.index(bird)].activate((bird.y, abs(bird.y - pipes[pipe_ind].height), abs(bird.y - pipes[pipe_ind].bottom)))
+        # send bird location, top pipe location and bottom pipe location and determine from network whether to jump or not
+        y = flock.y[alive]
+        output = nets.activate(alive, np.column_stack((y, abs(y - pipes[pipe_ind].height), abs(y - pipes[pipe_ind].bottom))))
+        jump = output[:, 0] > 0.5  # we use a tanh activation function so result will be between -1 and 1. if over 0.5 jump
+        flock.jump(alive[jump])
 
-            if output[0] > 0.5:  # we use a tanh activation function so result will be between -1 and 1. if over 0.5 jump
-                bird.jump()
+        if timer is not None:
+            t = timer.lap("activate", t)
 
         base.move()
 
@@ -368,74 +1408,388 @@ def main(genomes, config):
         for pipe in pipes:
             pipe.move()
             # check for collision
-            for bird in birds:
-                if pipe.collide(bird, win):
-                    ge[birds.index(bird)].fitness -= 1
-                    nets.pop(birds.index(bird))
-                    ge.pop(birds.index(bird))
-                    birds.remove(bird)
+            hit = flock.collide(pipe, alive)
+            fitness[alive[hit]] -= 1
+            flock.kill(alive[hit])
+            alive = alive[~hit]
 
             if pipe.x + pipe.PIPE_TOP.get_width() < 0:
                 rem.append(pipe)
 
-            if not pipe.passed and pipe.x < bird.x:
+            if not pipe.passed and pipe.x < flock.x:
                 pipe.passed = True
                 add_pipe = True
 
         if add_pipe:
             score += 1
             # can add this line to give more reward for passing through a pipe (not required)
-            for genome in ge:
-                genome.fitness += 5
-            pipes.append(Pipe(WIN_WIDTH))
+            fitness[alive] += 5
+            pipes.append(Pipe(WIN_WIDTH, course, n_pipes))
+            n_pipes += 1
 
         for r in rem:
             pipes.remove(r)
 
-        for bird in birds:
-            if bird.y + bird.img.get_height() - 10 >= FLOOR or bird.y < -50:
-                nets.pop(birds.index(bird))
-                ge.pop(birds.index(bird))
-                birds.pop(birds.index(bird))
+        if timer is not None:
+            t = timer.lap("pipes", t)
+
+        out = flock.off_screen(alive)
+        flock.kill(alive[out])
+        alive = alive[~out]
+
+        if timer is not None:
+            t = timer.lap("cull", t)
+
+        flock.animate(alive)
+        if render:
+            draw_window(WIN, flock, pipes, base, score, gen, pipe_ind, fitness)
+
+        if timer is not None:
+            timer.lap("draw", t)
+
+        # stop early if the generation has used up its frames, time or score
+        frames += 1
+        stop = budget.check(frames, deadline, score)
+        if stop is not None:
+            break
+
+    return fitness, stop
+
+
+def eval_genomes(genomes, config):
+    """
+    runs the simulation of the current population of
+    birds and sets their fitness based on the distance they
+    reach in the game. When HEADLESS nothing is drawn and the
+    frame rate is not capped.
+    """
+    global gen
+    gen += 1
+    seed = course_seed(gen)
+    draw = not HEADLESS
+
+    def fly(genomes):
+        for genome_id, genome in genomes:
+            genome.fitness = 0  # start with fitness level of 0
+
+        # genome number i is played by bird index[i] of the batch
+        nets, index = compile_networks(genomes, config, dedup=not draw)
+        fitness, stop = simulate(nets, Course(seed), draw=draw)
+        if stop is not None:
+            report("Generation stopped early: " + stop)
+
+        for (genome_id, genome), row in zip(genomes, index):
+            genome.fitness = float(fitness[row])
+
+    if draw:
+        # every genome is drawn and counted as alive, skip none of them
+        fly(genomes)
+    else:
+        evaluate_cached(genomes, seed, fly)
+
 
-        draw_window(WIN, birds, pipes, base, score, gen, pipe_ind)
+def eval_chunk(nets, course, budget, deadline):
+    """
+    simulate part of a generation in a worker process
+    :param nets: NetworkBatch of the chunk
+    :param course: the generation's Course
+    :param budget: Budget of the generation
+    :param deadline: time.time() the generation has to stop at, or None
+    :return: list with the fitness of every network, why the chunk
+             stopped early (str) or None, the phase times of the
+             worker's TIMER or None and the seconds it took
+    """
+    start = time.perf_counter()
+    if len(nets) == 0:
+        return [], None, None, 0.0
+    if TIMER is not None:
+        TIMER.reset()
+    fitness, stop = simulate(nets, course, budget=budget, deadline=deadline)
+    return fitness.tolist(), stop, TIMER.times if TIMER is not None else None, time.perf_counter() - start
+
+
+def worker(conn, timing):
+    """
+    main loop of a worker process of ParallelEvaluator. The networks
+    of a generation are read straight from the shared memory block
+    the main process compiled them into, and only the fitness is sent
+    back. Nothing is drawn, so the display is never set up. Ctrl-C is
+    left to the main process
+    :param conn: end of a multiprocessing Pipe to the main process
+    :param timing: time the frames with a PhaseTimer (bool)
+    :return: None
+    """
+    global TIMER
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    TIMER = PhaseTimer() if timing else None
+    shm = None
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        name, layout, start, stop, course, budget, deadline = job
+        if shm is None or shm.name != name:
+            if shm is not None:
+                shm.close()
+            shm = shared_memory.SharedMemory(name)
+        nets = NetworkBatch.unpack(shm.buf, layout).rows(start, stop)
+        result = eval_chunk(nets, course, budget, deadline)
+        del nets  # views of shm.buf, which can not be closed while they exist
+        conn.send(result)
+    if shm is not None:
+        shm.close()
+    conn.close()
+
+
+class ParallelEvaluator:
+    """
+    Evaluates generations on worker processes that are started once
+    and stay up for the whole run. Every generation the networks are
+    compiled once into a NetworkBatch that is packed into a shared
+    memory block. The population is handed out in chunks of rows: a
+    worker that finishes a chunk gets the next one, so a worker stuck
+    with a bird that survives for long does not hold up the others.
+    Chunks are sized to take about CHUNK_SECONDS from the time earlier
+    chunks took, and shrink towards the end of a generation. All
+    chunks fly the same pipe course, so the fitness is the same as
+    with eval_genomes. The course is written once to a memory mapped
+    file that all workers read. Nothing is drawn
+    """
+    CHUNK_SECONDS = 0.05  # aim for chunks that take about this long
+    MIN_CHUNK = 4  # fewer birds per chunk lose most of the batching
+
+    def __init__(self, num_workers):
+        """
+        start the worker processes
+        :param num_workers: number of processes (int)
+        :return: None
+        """
+        self.num_workers = num_workers
+        self.conns = []
+        self.workers = []
+        self.shm = None  # shared memory block of the networks, grown when a generation needs more
+        self.genome_seconds = None  # running average of the seconds a chunk takes per genome
+        self.utilization = []  # fraction of every generation each worker was busy
+        # started before the workers so they share it, and a worker that
+        # exits does not take the blocks it had attached with it
+        resource_tracker.ensure_running()
+        for i in range(num_workers):
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=worker, args=(child_conn, TIMER is not None), daemon=True)
+            process.start()
+            child_conn.close()
+            self.conns.append(conn)
+            self.workers.append(process)
+        self.course_dir = tempfile.TemporaryDirectory(prefix="flappy_courses_")
+
+    def close(self):
+        """
+        stop the worker processes and remove the course files and the
+        shared memory. Workers that are still busy, e.g. after Ctrl-C,
+        are terminated
+        :return: None
+        """
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for process in self.workers:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        for conn in self.conns:
+            conn.close()
+        self.course_dir.cleanup()
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def share(self, nets):
+        """
+        pack the networks of a generation into the shared memory block
+        :param nets: NetworkBatch
+        :return: layout of the networks in the block
+        """
+        if self.shm is None or self.shm.size < nets.nbytes():
+            size = nets.nbytes()
+            if self.shm is not None:
+                size = max(size, 2 * self.shm.size)
+                self.shm.close()
+                self.shm.unlink()
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        return nets.pack(self.shm.buf)
+
+    def evaluate(self, genomes, config):
+        """
+        fitness function for neat.Population.run, sets the fitness of all genomes
+        :param genomes: list of (genome_id, genome)
+        :param config: neat config
+        :return: None
+        """
+        global gen
+        gen += 1
+        seed = course_seed(gen)
+        evaluate_cached(genomes, seed, lambda todo: self.simulate(todo, config, seed))
 
-        # break if score gets large enough
-        '''if score > 20:
-            pickle.dump(nets[0],open("best.pickle", "wb"))
-            break'''
+    def simulate(self, genomes, config, seed):
+        """
+        let the workers fly the genomes over a course and set their fitness
+        :param genomes: list of (genome_id, genome), not empty
+        :param config: neat config
+        :param seed: seed of the course (int)
+        :return: None
+        """
+        course = Course(seed, path=os.path.join(self.course_dir.name, "course_%d.npy" % seed))
+        if BUDGET.max_seconds is not None:
+            # rows handed out after the deadline fly a single frame, which
+            # genomes those are must not depend on their place in the population
+            genomes = random.Random(seed).sample(genomes, len(genomes))
+
+        nets, index = compile_networks(genomes, config)
+        groups = [[] for row in range(len(nets))]  # genomes of every row
+        for (genome_id, genome), row in zip(genomes, index):
+            groups[row].append(genome)
+
+        layout = self.share(nets)
+        start = time.perf_counter()
+        # one deadline for the whole generation, not one per chunk
+        deadline = BUDGET.deadline(time.time())
+        next_row = 0
+        busy = [0.0] * self.num_workers
+        chunks = [0] * self.num_workers
+        running = {}  # conn: (worker number, first row, row after the last, sent after the deadline)
+        stops = set()
+        late = 0  # genomes sent after the deadline
+
+        def send_chunk(i):
+            nonlocal next_row, late
+            size = self.chunk_size(len(nets) - next_row)
+            # after the deadline simulate stops after one frame, send the rest at once
+            after = deadline is not None and time.time() >= deadline
+            if after:
+                size = len(nets) - next_row
+                late += sum(len(group) for group in groups[next_row:])
+            running[self.conns[i]] = (i, next_row, next_row + size, after)
+            self.conns[i].send((self.shm.name, layout, next_row, next_row + size, course, BUDGET, deadline))
+            next_row += size
+
+        for i in range(self.num_workers):
+            if next_row < len(nets):
+                send_chunk(i)
+
+        while running:
+            for conn in multiprocessing.connection.wait(list(running)):
+                i, first, last, after = running.pop(conn)
+                fitnesses, stop, times, seconds = conn.recv()
+                for group, fitness in zip(groups[first:last], fitnesses):
+                    for genome in group:
+                        genome.fitness = fitness
+                if stop is not None:
+                    stops.add(stop)
+                if times is not None and TIMER is not None:
+                    TIMER.merge(times)
+                busy[i] += seconds
+                chunks[i] += 1
+                if not after:  # a single frame says nothing about how long chunks take
+                    per_genome = seconds / (last - first)
+                    self.genome_seconds = per_genome if self.genome_seconds is None else 0.7 * self.genome_seconds + 0.3 * per_genome
+                if next_row < len(nets):
+                    send_chunk(i)
+
+        elapsed = time.perf_counter() - start
+        self.utilization.append([seconds / elapsed for seconds in busy])
+        report("Workers busy: " + ", ".join("%d%% (%d chunks)" % (100 * used, n) for used, n in zip(self.utilization[-1], chunks)))
+        if late:
+            stops.add("%d genomes started after the deadline" % late)
+        if stops:
+            report("Generation stopped early: " + ", ".join(sorted(stops)))
+        os.remove(course.path)
+
+    def chunk_size(self, remaining):
+        """
+        number of genomes to give a worker that is ready for more
+        :param remaining: genomes of the generation not handed out yet (int)
+        :return: int
+        """
+        # leave enough chunks for every worker to get some of the rest
+        size = remaining // (2 * self.num_workers)
+        if self.genome_seconds:
+            size = min(size, int(self.CHUNK_SECONDS / self.genome_seconds))
+        return min(remaining, max(size, self.MIN_CHUNK))
 
 
-def run(config_file):
+def run(config_file, workers=1, generations=50, save=None):
     """
     runs the NEAT algorithm to train a neural network to play flappy bird.
     :param config_file: location of config file
-    :return: None
+    :param workers: number of processes evaluating genomes, more than 1 trains without drawing
+    :param generations: number of generations to run for (int)
+    :param save: file to pickle the best genome to, or None
+    :return: the best genome
     """
+    global reporters
+
     config = neat.config.Config(neat.DefaultGenome, neat.DefaultReproduction,
                          neat.DefaultSpeciesSet, neat.DefaultStagnation,
                          config_file)
 
     # Create the population, which is the top-level object for a NEAT run.
     p = neat.Population(config)
+    reporters = p.reporters
 
     # Add a stdout reporter to show progress in the terminal.
     p.add_reporter(neat.StdOutReporter(True))
     stats = neat.StatisticsReporter()
     p.add_reporter(stats)
+    if TIMER is not None:
+        p.add_reporter(TimingReporter(TIMER))
     #p.add_reporter(neat.Checkpointer(5))
 
     # Run for up to 50 generations.
-    winner = p.run(main, 50)
+    if workers > 1:
+        evaluator = ParallelEvaluator(workers)
+        try:
+            winner = p.run(evaluator.evaluate, generations)
+        finally:
+            evaluator.close()
+    else:
+        winner = p.run(eval_genomes, generations)
 
     # show final stats
     print('\nBest genome:\n{!s}'.format(winner))
 
+    if save is not None:
+        with open(save, "wb") as f:
+            pickle.dump(winner, f)
+    return winner
+
+
+def replay(genome_file, config_file, seed=None):
+    """
+    watch a trained genome play one game
+    :param genome_file: file with a genome pickled by run
+    :param config_file: location of config file
+    :param seed: seed of the pipe course, None for a random course
+    :return: fitness of the game (float)
+    """
+    config = neat.config.Config(neat.DefaultGenome, neat.DefaultReproduction,
+                         neat.DefaultSpeciesSet, neat.DefaultStagnation,
+                         config_file)
+    with open(genome_file, "rb") as f:
+        genome = pickle.load(f)
+
+    net = neat.nn.FeedForwardNetwork.create(genome, config)
+    if seed is None:
+        seed = random.randrange(2**32)
+    fitness, stop = simulate(NetworkBatch([net]), Course(seed), draw=True)
+    return float(fitness[0])
+
 
 if __name__ == '__main__':
-    # Determine path to configuration file. This path manipulation is
-    # here so that the script will run successfully regardless of the
-    # current working directory.
-    local_dir = os.path.dirname(__file__)
-    config_path = os.path.join(local_dir, 'config-feedforward.txt')
+    # trains with the defaults, python flappy.py train has the options.
+    # Importing flappy here would import this file a second time
+    config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config-feedforward.txt')
     run(config_path)